@@ -1,20 +1,103 @@
 import traceback
+import sys
+import queue
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import os
 import re
 import argparse
 import getpass
+import functools
 import imaplib
 import email
 import email.header
+import email.parser
 from datetime import datetime
 from colorama import init, Style, Fore, Back
 
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+try:
+    # optional native (Rust) parser, much faster than the email package
+    import fast_mail_parser
+except ImportError:
+    fast_mail_parser = None
+
 init(autoreset=True)
 
-PATTERN_UID = re.compile(r'\d+ \(UID (?P<uid>\d+)\)')
+# imaplib rejects protocol lines longer than 1MB by default (message literals
+# are read by size, whatever their lines), which the '* SEARCH' response of
+# folders of roughly 150k messages or more exceeds
+imaplib._MAXLINE = 10000000
+
+# the parsers read the whole of their input (the body as a single payload), so
+# they are only given the header section of the messages, see message_headers()
+HEADER_PARSER = email.parser.BytesHeaderParser()
+
+PATTERN_HEADERS_END = re.compile(rb'\r?\n\r?\n')
+# line break of a header folded over several lines
+PATTERN_FOLDING = re.compile(r'\r?\n[ \t]')
+PATTERN_LIST = re.compile(r'\((?P<flags>.*?)\) (?P<delim>"[^"]*"|NIL) (?P<name>.+)$')
+# backslash escape (of a backslash or a double quote) in an IMAP quoted string
+PATTERN_QUOTED_ESCAPE = re.compile(r'\\(.)')
+
+# characters removed (or replaced) from subjects and message IDs to make them
+# valid file names
+SUBJECT_TRANSLATION = str.maketrans({'\n': None, '\r': None, '"': None, '/': '-'})
+MESSAGE_ID_TRANSLATION = str.maketrans(dict.fromkeys('<>$\\/'))
+
+# maximum total size of the messages of a FETCH batch (a larger message makes a
+# batch of its own), to bound the memory held per folder
+FETCH_BATCH_BYTES = 32 * 1024 * 1024
+
+# file descriptors kept aside from the unsynced files of --durable, for the
+# connections, directories and the parse pool
+RESERVED_FDS = 64
+
+# attempts at a deletion before giving up, reconnecting between them
+DELETE_ATTEMPTS = 3
+# maximum number of messages per deletion command, to bound its length
+DELETE_BATCH = 1000
+
+# folders of at least this many messages have their headers parsed by a pool of
+# PARSE_WORKERS processes, the rest of the program being mostly network-bound
+PARSE_POOL_THRESHOLD = 1000
+PARSE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# number of messages between two progress lines of a folder
+PROGRESS_INTERVAL = 100 if sys.stdout.isatty() else 1000
+
+# serializes output of the folder workers
+PRINT_LOCK = threading.Lock()
+
+# IMAP connection of each folder worker, reused across the folders it downloads
+worker_state = threading.local()
+# set on an error or interruption, for the folder workers to stop early
+stop_event = threading.Event()
+# every connection opened, to log them out when done
+connections = []
+# process pool parsing the headers of large folders, set by main()
+parse_pool = None
+
+
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+
+    return value
+
 
 argparser = argparse.ArgumentParser(
-    description='Dump a IMAP folder into .eml files.')
+    description='Dump a IMAP folder into .eml files.',
+    epilog='Messages are downloaded with BODY.PEEK[], so their flags (like \\Seen) are not '
+           'modified on the server.')
 argparser.add_argument('-s', '--server', dest='server',
                        help='IMAP server, like imap.gmail.com', required=True)
 argparser.add_argument('-p', '--port', dest='port',
@@ -34,217 +117,755 @@ argparser.add_argument('-d', '--delete-remote', dest='delete_remote',
                        help='Should delete from remote folder?', nargs='?', const='delete')
 argparser.add_argument('-t', '--trash-folder', dest='trash_folder', help='Remote trash folder name',
                        default='Trash')
+argparser.add_argument('--fetch-batch', dest='fetch_batch',
+                       help='Maximum number of messages to download per IMAP FETCH command',
+                       default=64, type=positive_int)
+argparser.add_argument('--parallel', dest='parallel',
+                       help='Number of folders to download in parallel, each over its own IMAP connection',
+                       default=4, type=positive_int)
+argparser.add_argument('--resume', dest='resume',
+                       help='Skip the messages already downloaded to the local folder, by first fetching '
+                            'their headers only. Such messages are not deleted from the remote folder',
+                       action='store_true')
+argparser.add_argument('--durable', dest='durable',
+                       help='fsync the written messages before deleting them or exiting, '
+                            'by groups of --batch-fsync messages', action='store_true')
+argparser.add_argument('--batch-fsync', dest='batch_fsync',
+                       help='Number of messages written between two fsync rounds with --durable',
+                       default=64, type=positive_int)
 args = argparser.parse_args()
 
+# each folder worker keeps up to --batch-fsync files open with --durable
+if args.durable and resource is not None:
+    max_fds = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if max_fds != resource.RLIM_INFINITY and \
+            args.parallel * args.batch_fsync + RESERVED_FDS > max_fds:
+        argparser.error('--batch-fsync {} with --parallel {} exceeds the limit of {} open files'
+                        .format(args.batch_fsync, args.parallel, max_fds))
+
+
+def log(*values, **kwargs):
+    with PRINT_LOCK:
+        print(*values, **kwargs)
+
 
 def parse_uid(data):
-    match = PATTERN_UID.match(data)
+    """Get the UID out of the raw bytes of a FETCH response, None if it has none."""
+    before, found, after = data.partition(b'UID ')
+    if not found:
+        return None
+
+    # the UID is followed by the next item, or closes the response
+    return after.split(b' ', 1)[0].split(b')', 1)[0].decode('ascii')
 
-    return match.group('uid')
 
+def fetch_message(mail, message_set):
+    # BODY.PEEK[] returns the same octets as RFC822 without setting \Seen,
+    # the UID is needed to delete the message afterwards
+    return mail.fetch(message_set, '(UID BODY.PEEK[])')
 
-def fetch_message(mail, num):
-    return mail.fetch(num, '(RFC822)')
 
+def fetch_sizes(mail):
+    """Get the size of every message of the selected folder.
+
+    Returns:
+        dict: the size (in bytes) of each message, by sequence number
+    """
+    rv, data = mail.fetch('1:*', '(RFC822.SIZE)')
+
+    if rv != 'OK':
+        raise OSError('Error getting message sizes', data)
+
+    sizes = {}
+    for item in data:
+        if isinstance(item, bytes) and b'RFC822.SIZE ' in item:
+            size = item.partition(b'RFC822.SIZE ')[2].split(b' ', 1)[0].split(b')', 1)[0]
+            sizes[item.split(b' ', 1)[0]] = int(size)
 
-def fetch_uid(mail, num):
-    return mail.fetch(num, '(UID)')
+    return sizes
 
 
-def trim_file_name(filename: str, file_ext: str, output_dir: str) -> str:
+def split_batches(nums, sizes):
+    """Split the given message sequence numbers into FETCH batches.
+
+    Batches have at most `--fetch-batch` messages and FETCH_BATCH_BYTES bytes,
+    except for the messages larger than that, which make a batch of their own.
+    """
+    batch = []
+    batch_bytes = 0
+    for num in nums:
+        size = sizes.get(num, 0)
+
+        if batch and (len(batch) >= args.fetch_batch or batch_bytes + size > FETCH_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+
+        batch.append(num)
+        batch_bytes += size
+
+    if batch:
+        yield batch
+
+
+def fetch_headers(mail, message_set):
+    # only the headers the file names are built from
+    return mail.fetch(message_set, '(BODY.PEEK[HEADER.FIELDS (SUBJECT DATE MESSAGE-ID)])')
+
+
+def fetched_messages(data):
+    """Iterate over the messages of a FETCH response.
+
+    imaplib returns a `(header, literal)` tuple per message, followed by the
+    rest of its response: usually just `b')'`, but that's where the server
+    may also put the items requested along with the literal (like the UID).
+
+    Yields:
+        tuple: the message sequence number, its UID (None if not fetched)
+            and its raw bytes
+    """
+    for i, item in enumerate(data):
+        if isinstance(item, tuple):
+            rest = data[i + 1] if i + 1 < len(data) and isinstance(data[i + 1], bytes) else b''
+            uid = parse_uid(item[0] + rest)
+
+            yield item[0].split(b' ', 1)[0], uid, item[1]
+
+
+def uid_set(uids):
+    """Compose an IMAP set of the given UIDs, made of ranges where contiguous."""
+    ranges = []
+    for uid in sorted(map(int, uids)):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+
+    return ','.join(str(first) if first == last else '{}:{}'.format(first, last)
+                    for first, last in ranges)
+
+
+def message_headers(raw_message):
+    """Get the header section of a raw message (all of it if it has no body)."""
+    match = PATTERN_HEADERS_END.search(raw_message)
+
+    return raw_message[:match.end()] if match else raw_message
+
+
+def decode_header_part(part, charset):
+    """Decode a part of a header, as returned by `email.header.decode_header()`."""
+    if isinstance(part, str):
+        return part
+
+    if charset in (None, 'unknown-8bit'):
+        # raw 8-bit header, nowadays most likely UTF-8
+        try:
+            return part.decode('utf-8')
+        except UnicodeDecodeError:
+            return part.decode('latin-1')
+
+    try:
+        return part.decode(charset, 'replace')
+    except LookupError:
+        # unknown charset
+        return part.decode('latin-1')
+
+
+def unfold_header(value):
+    """Join the lines of a folded header value, as fast_mail_parser does (None if missing)."""
+    if value is None:
+        return None
+
+    # raw 8-bit values are Header objects
+    return PATTERN_FOLDING.sub(' ', str(value))
+
+
+def parse_headers(raw_headers):
+    """Parse the headers the file name of a message is composed from.
+
+    Uses fast_mail_parser if installed, falling back to the email package if
+    it isn't or if it fails on the message.
+
+    Returns:
+        tuple: the decoded Subject, and the Date and Message-ID headers,
+            each None if missing
+    """
+    if fast_mail_parser is not None:
+        try:
+            parsed = fast_mail_parser.parse_email(raw_headers)
+            # depending on the version, the values are strings or lists of them
+            headers = {name.lower(): value[0] if isinstance(value, list) else value
+                       for name, value in parsed.headers.items()}
+
+            return headers.get('subject'), headers.get('date'), headers.get('message-id')
+        except Exception:
+            pass
+
+    msg = HEADER_PARSER.parsebytes(raw_headers)
+
+    subject = msg['Subject']
+    if isinstance(subject, str):
+        # unfolded before decoding, decode_header() would drop the line break
+        # after an encoded word along with the white space following it
+        subject = unfold_header(subject)
+    if subject is not None:
+        # joining the decoded parts directly, make_header() would decode them
+        # once more and is slow on pathological headers
+        subject = ''.join(decode_header_part(part, charset)
+                          for part, charset in email.header.decode_header(subject))
+
+    return unfold_header(subject), unfold_header(msg['Date']), unfold_header(msg['Message-ID'])
+
+
+def extract_meta(raw_headers):
+    """Extract the metadata the file name of a message is composed from.
+
+    Args:
+        raw_headers: the header section of the raw message
+    Returns:
+        tuple: the subject, the date (followed by ' - ') and the message ID,
+            the latter being empty if unknown
+    """
+    # try to extract email metadata
+    subject = 'No subject'
+    date = ''
+    message_id = ''
+    try:
+        subject, date_header, message_id = parse_headers(raw_headers)
+
+        date_tuple = email.utils.parsedate_tz(date_header)
+
+        if date_tuple:
+            datetime_ = datetime.fromtimestamp(
+                email.utils.mktime_tz(date_tuple))
+
+            date = datetime_.strftime('%Y-%m-%d %H:%M:%S') + ' - '
+    except:
+        pass
+
+    # if metadata extraction failed, skip this email
+    if subject is None:
+        subject = "No Subject"
+    if not date:
+        date = "Unknown Date"
+
+    return subject, date, (message_id or '').strip()
+
+
+def trim_file_name(filename: str, file_ext: str, name_max: int) -> str:
     """Shorten the given filename if it is too long for the filesystem.
 
+    Args:
+        name_max: the maximum file name length (in bytes) of the output
+            directory, as given by `os.pathconf(output_dir, 'PC_NAME_MAX')`
     Returns:
         str: the filename without the extension
     """
-    # Get the maximum file name length (in bytes) for the specified directory
-    max_length = os.pathconf(output_dir, 'PC_NAME_MAX')
-
     # Encode filename and extension to UTF-8
     filename_bytes = filename.encode('utf-8')
     ext_bytes = file_ext.encode('utf-8')
 
     # Calculate the available byte length for the main part of the filename
     # Reserve space for extension and separator (e.g., '.')
-    max_main_bytes = max_length - len(ext_bytes) - 1
+    max_main_bytes = name_max - len(ext_bytes) - 1
 
     # Check if trimming is necessary
     if len(filename_bytes) > max_main_bytes:
-        # Trim and decode safely, ensuring no character is split
-        filename_bytes = filename_bytes[:max_main_bytes]
+        # Trim and decode, dropping the character split by the cut (if any)
+        filename = filename_bytes[:max_main_bytes].decode('utf-8', 'ignore')
+
+    return filename
+
+
+def write_file(path, data, unsynced=None):
+    """Write the given bytes to a new (or truncated) file.
+
+    Uses the raw file descriptor: the data is already in one buffer, so the
+    buffered file object of `open()` would only add overhead.
+
+    Args:
+        unsynced: if given, the file is left open and its descriptor appended
+            to this list, for `sync_files()` to fsync and close it later
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            # a single write() may be partial for very large messages
+            view = view[os.write(fd, view):]
+    except BaseException:
+        os.close(fd)
+        # don't leave a truncated message behind, --resume would skip it
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        raise
+
+    if unsynced is None:
+        os.close(fd)
+    else:
+        unsynced.append(fd)
+
+
+def sync_dir(path):
+    """Flush the entries of the given directory to disk."""
+    dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def make_dirs(path):
+    """Create the given directory and its missing parents, like `os.makedirs()`.
+
+    With `--durable`, the parent of each created directory is fsynced as well,
+    or the directory (and the messages in it) could be lost on a crash.
+    """
+    created = []
+    missing = path
+    while not os.path.isdir(missing):
+        created.append(missing)
+        missing = os.path.dirname(missing)
+
+    os.makedirs(path, exist_ok=True)
+
+    if args.durable:
+        for directory in reversed(created):
+            sync_dir(os.path.dirname(directory))
+
+
+def sync_files(unsynced, dir_fd):
+    """Flush the given files and then their directory to disk, and close the files.
+
+    Issuing the fsyncs back to back lets the filesystem commit them together,
+    instead of paying a full journal commit per message.
+    """
+    try:
+        for fd in unsynced:
+            os.fsync(fd)
+        os.fsync(dir_fd)
+    finally:
+        for fd in unsynced:
+            os.close(fd)
+        unsynced.clear()
+
+
+def write_messages(write_queue, errors, output_dir):
+    """Write the `(path, raw_message)` items of the queue to disk.
+
+    Runs on its own thread so that disk writes overlap with the next FETCH.
+    Stops at a `None` item; the first error is stored in `errors` and the
+    remaining items are drained without being written.
+    With `--durable`, the files of `output_dir` are fsynced by groups of
+    `--batch-fsync`, and once more when stopping.
+    """
+    dir_fd = os.open(output_dir, os.O_RDONLY | os.O_DIRECTORY) if args.durable else None
+    unsynced = []
+
+    try:
         while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            if errors:
+                continue
+
+            path, raw_message = item
             try:
-                filename = filename_bytes.decode('utf-8')
-                break  # Success: valid UTF-8
-            except UnicodeDecodeError:
-                # Remove one more byte and try again
-                filename_bytes = filename_bytes[:-1]
+                if args.durable:
+                    write_file(path, raw_message, unsynced)
 
-    return filename
+                    if len(unsynced) >= args.batch_fsync:
+                        sync_files(unsynced, dir_fd)
+                else:
+                    write_file(path, raw_message)
+            except BaseException as e:
+                errors.append(e)
+
+        if args.durable and not errors:
+            try:
+                sync_files(unsynced, dir_fd)
+            except BaseException as e:
+                errors.append(e)
+    finally:
+        for fd in unsynced:
+            os.close(fd)
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+
+def fetch_batches(mail, batches, use_pool):
+    """Fetch the given batches of messages and parse their headers.
+
+    When resuming, only the headers of the messages are fetched. With
+    `use_pool`, the headers of a batch are parsed by the process pool while
+    the next batch is fetched, the batch being yielded only then.
+
+    Yields:
+        tuple: the `(num, uid, raw_message)` of the messages of a batch, and
+            an iterator over their `extract_meta()` results
+    """
+    pending = None
+    for batch in batches:
+        if stop_event.is_set():
+            return
 
+        # when resuming, the headers are enough to find the already downloaded
+        # messages, the whole of the others is fetched by process()
+        if args.resume:
+            rv, data = fetch_headers(mail, b','.join(batch).decode())
+        else:
+            rv, data = fetch_message(mail, b','.join(batch).decode())
+
+        if rv != 'OK':
+            raise OSError('Error getting messages', batch)
+
+        messages = list(fetched_messages(data))
+        headers = [message_headers(raw_message) for num, uid, raw_message in messages]
+        if use_pool:
+            # only the headers are sent over to the pool, not whole messages;
+            # map() submits them all right away
+            metas = parse_pool.map(extract_meta, headers,
+                                   chunksize=max(1, len(headers) // PARSE_WORKERS))
+
+            if pending is not None:
+                yield pending
+            pending = messages, metas
+        else:
+            yield messages, map(extract_meta, headers)
+
+    if pending is not None:
+        yield pending
+
+
+def progress(processed, total, skipped):
+    """Compose the progress of a folder, like '100/1500 messages (20 already downloaded)'."""
+    return (str(processed) + '/' + str(total) + ' messages' +
+            (' (' + str(skipped) + ' already downloaded)' if skipped else ''))
 
-def process(mail, folder):
+
+def process(mail, folder, name):
     rv, data = mail.search(None, 'ALL')
 
     if rv != 'OK':
         raise FileNotFoundError('No messages found!', folder)
 
-    print(Fore.BLUE + str(len(data[0])) + ' messages found!')
+    nums = data[0].split()
+    log(Fore.BLUE + folder + ': ' + str(len(nums)) + ' messages found!')
+
+    FILENAME_EXT = "eml"
+
+    final_dir = os.path.join(args.local_folder, name)
+    make_dirs(final_dir)
+
+    # maximum file name length (in bytes) of the folder's directory
+    name_max = os.pathconf(final_dir, 'PC_NAME_MAX')
+
+    write_queue = queue.Queue(maxsize=8)
+    write_errors = []
+    writer = threading.Thread(target=write_messages,
+                              args=(write_queue, write_errors, final_dir), daemon=True)
+    writer.start()
+
+    # sizes of the messages downloaded by a previous run, by file name
+    existing_files = {}
+    if args.resume:
+        with os.scandir(final_dir) as entries:
+            existing_files = {entry.name: entry.stat().st_size
+                              for entry in entries if entry.is_file()}
 
-    if not os.path.isdir(args.local_folder):
-        raise NotADirectoryError('Local folder not found.')
+    # header parsing is CPU-bound, offload it from the GIL for large folders
+    use_pool = parse_pool is not None and len(nums) >= PARSE_POOL_THRESHOLD
 
     unknown_message_id_counter = 0  # counter for unknown email message IDs
-    for num in data[0].split():
-        output_dir = os.path.abspath(args.local_folder)
-        rv, data = fetch_message(mail, num)
+    to_delete = []
+    processed = reported = skipped = 0  # progress counters
+    sizes = fetch_sizes(mail) if nums else {}
 
-        if rv != 'OK':
-            raise OSError('Error getting message', num)
+    try:
+        for messages, metas in fetch_batches(mail, split_batches(nums, sizes), use_pool):
+            if write_errors or stop_event.is_set():
+                break
 
-        try:
-            msg = email.message_from_bytes(data[0][1])
-        except:
-            msg = email.message_from_string(data[0][1])
-
-        # try to extract email metadata
-        subject = 'No subject'
-        date = ''
-        message_id = ''
-        try:
-            header = email.header.make_header(
-                email.header.decode_header(msg['Subject']))
+            files = {}
+            for (num, uid, raw_message), (subject, date, message_id) in zip(messages, metas):
 
-            subject = str(header)
+                if not message_id:
+                    unknown_message_id_counter += 1
+                    message_id = str(unknown_message_id_counter)
 
-            date_tuple = email.utils.parsedate_tz(msg['Date'])
+                # compose file name from date, message-ID and subject
+                # removing illegal filename-characters
+                subject = subject.translate(SUBJECT_TRANSLATION).strip()
+                message_id = message_id.translate(MESSAGE_ID_TRANSLATION)
 
-            if date_tuple:
-                datetime_ = datetime.fromtimestamp(
-                    email.utils.mktime_tz(date_tuple))
+                file = date + message_id + ' - ' + subject
 
-                date = datetime_.strftime('%Y-%m-%d %H:%M:%S') + ' - '
-            message_id = msg['Message-ID']
-        except:
-            pass
+                # trim filename if it's too long
+                files[num] = trim_file_name(file, FILENAME_EXT, name_max)
+
+            if args.resume:
+                missing = []
+                for num, file in files.items():
+                    size = existing_files.get(file + '.' + FILENAME_EXT)
+                    # a file of another size was left partial by an interrupted run
+                    if size is not None and size == sizes.get(num, size):
+                        skipped += 1
+                    else:
+                        missing.append(num)
 
-        # if metadata extraction failed, skip this email
-        if subject is None:
-            subject = "No Subject"
-        if not date:
-            date = "Unknown Date"
-        if not message_id:
-            unknown_message_id_counter += 1
-            message_id = str(unknown_message_id_counter)
+                messages = []
+                if missing:
+                    rv, data = fetch_message(mail, b','.join(missing).decode())
 
-        # compose file name from date, message-ID and subject
-        # removing illegal filename-characters
-        subject = re.sub(r'(\n|\r|\r\n|\")', '', subject)
-        subject = re.sub(r'/', '-', subject).strip()
-        message_id = re.sub(r'(\<|\>|\$|\\|\/)', '', message_id)
+                    if rv != 'OK':
+                        raise OSError('Error getting messages', missing)
 
-        file = date + message_id + ' - ' + subject
-        FILENAME_EXT = "eml"
+                    messages = list(fetched_messages(data))
 
-        final_dir = os.path.join(output_dir, folder.replace('"', ''))
-        if not os.path.isdir(final_dir):
-            os.makedirs(final_dir)
+            for num, uid, raw_message in messages:
+                file = files[num]
 
-        # trim filename if it's too long
-        file = trim_file_name(file, FILENAME_EXT, final_dir)
+                write_queue.put(
+                    (os.path.join(final_dir, file + '.' + FILENAME_EXT), raw_message))
 
-        print(Fore.BLUE + '\tWriting message at "' + file + '"... ', end='')
+                if args.delete_remote is not None:
+                    to_delete.append(uid)
 
-        with open('{}/{}.{}'.format(final_dir, file, FILENAME_EXT), 'wb') as f:
-            f.write(data[0][1])
+            processed += len(files)
+            # the messages are only queued for writing at this point
+            if processed - reported >= PROGRESS_INTERVAL and processed < len(nums):
+                reported = processed
+                log(Fore.BLUE + '\t' + folder + ': ' + progress(processed, len(nums), skipped) +
+                    '...')
+    finally:
+        # wait for the pending writes, messages must be on disk before deletion
+        write_queue.put(None)
+        writer.join()
 
-        print(Fore.GREEN + 'Done.',
-              end='' if args.delete_remote is not None else '\n')
+    if write_errors:
+        raise write_errors[0]
 
-        if args.delete_remote is not None:
-            delete(mail, num)
+    if nums and processed == len(nums):
+        log(Fore.BLUE + '\t' + folder + ': ' + progress(processed, len(nums), skipped) +
+            '... ' + Fore.GREEN + 'Done.')
 
+    # don't delete anything once the dump is being stopped
+    if to_delete and not stop_event.is_set():
+        delete(mail, to_delete, folder)
 
-def delete(mail, num):
-    print(Fore.RED + ' Deleting... ', end='')
 
-    try:
-        rv, data = fetch_uid(mail, num)
-        msg_uid = parse_uid(data[0].decode())
+def delete(mail, uids, folder):
+    """Move the given messages to the trash folder and expunge them.
 
-        result = mail.uid('COPY', msg_uid, args.trash_folder)
+    Messages are handled by groups of DELETE_BATCH, with one COPY and STORE
+    each, and expunged at the end if any were flagged. Retries on a broken
+    connection, over a new one.
 
-        if result[0] == 'OK':
-            mv, data = mail.uid('STORE', msg_uid, '+FLAGS', '(\\Deleted)')
-            mail.expunge()
+    Returns:
+        the connection, a new one if the given one broke
+    """
+    flagged = False
+    for start in range(0, len(uids), DELETE_BATCH):
+        batch = uid_set(uids[start:start + DELETE_BATCH])
+        count = str(len(uids[start:start + DELETE_BATCH]))
 
-            print(Fore.RED + 'Ok.')
-        else:
-            print(Back.RED + Fore.BLACK + 'Failed!')
-    except:
-        return delete(mail, num)
+        for attempt in range(DELETE_ATTEMPTS):
+            try:
+                if attempt:
+                    # in the try, a failed reconnection takes an attempt as well
+                    mail = reconnect(folder)
+
+                # if the connection broke after the server ran a COPY but
+                # before its response, the retry copies the messages to the
+                # trash folder once more: duplicates there are preferred over
+                # deleting messages that may not have been copied
+                result = mail.uid('COPY', batch, args.trash_folder)
+
+                if result[0] == 'OK':
+                    result = mail.uid('STORE', batch, '+FLAGS', '(\\Deleted)')
+
+                if result[0] == 'OK':
+                    flagged = True
+                    log(Fore.RED + '\tDeleting ' + count + ' messages of ' + folder + '... Ok.')
+                else:
+                    log(Fore.RED + '\tDeleting ' + count + ' messages of ' + folder + '... ' +
+                        Back.RED + Fore.BLACK + 'Failed!')
+
+                break
+            except (imaplib.IMAP4.abort, OSError):
+                if attempt == DELETE_ATTEMPTS - 1:
+                    raise
+
+                time.sleep(0.5 * (1 << attempt))
+
+    if flagged:
+        mail.expunge()
+
+    return mail
+
+
+def connect():
+    mail = imaplib.IMAP4_SSL(args.server, args.port)
+    connections.append(mail)
+
+    mail.login(args.username, args.password)
+
+    return mail
+
+
+def worker_connection():
+    """Get the IMAP connection of the current worker thread, opening it if needed."""
+    if getattr(worker_state, 'mail', None) is None:
+        worker_state.mail = connect()
+
+    return worker_state.mail
+
+
+def reconnect(folder):
+    """Replace the connection of the current worker by a new one, with `folder` selected."""
+    mail = connect()
+    worker_state.mail = mail
+
+    rv, data = mail.select(folder)
+
+    if rv != 'OK':
+        raise ConnectionError('Unable to open mailbox.', folder, rv)
+
+    return mail
+
+
+def run_folder(folder, name):
+    """Download the given remote folder over the connection of the worker.
+
+    Args:
+        folder: the name of the folder as sent by the server, to SELECT it
+        name: its unquoted name, that of its local directory
+    """
+    mail = worker_connection()
+
+    rv, data = mail.select(folder)
+
+    if rv == 'OK':
+        log(Fore.GREEN + 'Processing mailbox: ' + Fore.YELLOW + folder)
+
+        process(mail, folder, name)
+
+        # process() expunges the deleted messages itself, so the mailbox is
+        # left without the implicit expunge of CLOSE; without UNSELECT support,
+        # the next SELECT or LOGOUT deselects it
+        mail = worker_connection()  # process() may have reconnected
+        if 'UNSELECT' in mail.capabilities:
+            mail.unselect()
+    else:
+        raise ConnectionError('Unable to open mailbox.', folder, rv)
+
+
+@functools.lru_cache(maxsize=None)
+def parse_remote_folders(remote_folders):
+    """Parse the (tuple of) LIST response lines of the server.
+
+    Returns:
+        list: a dict per remote folder, with its 'original' name as sent by the
+            server (quoted if needed, to SELECT it), its unquoted 'name', its
+            'lower' case name to match the user input against and its 'flags'
+    """
+    remote_folders_map = []
+
+    for remote_folder in remote_folders:
+        match = PATTERN_LIST.match(remote_folder.decode())
+        original = match.group('name')
+        name = original
+        if len(original) > 1 and original.startswith('"') and original.endswith('"'):
+            name = PATTERN_QUOTED_ESCAPE.sub(r'\1', original[1:-1])
+
+        remote_folders_map.append({
+            'original': original,
+            'name': name,
+            'lower': name.lower().strip(),
+            'flags': match.group('flags').lower().split()
+        })
+
+    return remote_folders_map
 
 
 def main():
+    global parse_pool
+
     if args.password is None:
         args.password = getpass.getpass('IMAP password: ')
 
-    mail = imaplib.IMAP4_SSL(args.server, args.port)
-
     try:
-        mail.login(args.username, args.password)
+        if not os.path.isdir(args.local_folder):
+            raise NotADirectoryError('Local folder not found.')
+        args.local_folder = os.path.abspath(args.local_folder)
 
-        remote_folders = mail.list()[1]
-        remote_folders_map = []
-
-        for remote_folder in remote_folders:
-            remote_folder = remote_folder.decode().split(' "." ')[1]
+        mail = connect()
 
-            remote_folders_map.append({
-                'original': remote_folder,
-                'lower': remote_folder.lower().strip()
-            })
+        remote_folders = mail.list()[1]
+        remote_folders_map = parse_remote_folders(tuple(remote_folders))
+        folders_by_lower = {f['lower']: f for f in remote_folders_map}
 
         if args.list is not None:
-            for folder in remote_folders:
-                print(folder.decode().split(' "." ')[1])
+            for folder in remote_folders_map:
+                print(folder['name'])
             return
         print(args.remote_folder)
         if args.remote_folder == '*':
-            args.remote_folder = [folder.decode().split(
-                ' "." ')[1].lower() for folder in remote_folders]
+            # \Noselect folders only exist in the hierarchy, they can't be opened;
+            # taken as listed, as several folders may have the same lower case name
+            folders = [folder for folder in remote_folders_map
+                       if '\\noselect' not in folder['flags']]
+            args.remote_folder = [folder['lower'] for folder in folders]
         else:
             args.remote_folder = list(
-                map(lambda x: x.strip(), str(args.remote_folder).lower().split(',')))
+                map(lambda x: x.strip().strip('"'), str(args.remote_folder).lower().split(',')))
 
-            diff = list(set(args.remote_folder) -
-                        set(list(map(lambda x: x['lower'], remote_folders_map))))
+            diff = list(set(args.remote_folder) - set(folders_by_lower))
 
             if len(diff) > 0:
                 raise AttributeError(
                     'Remote folders not found: ' + ', '.join(diff))
-        print(args.remote_folder)
-        for folder in args.remote_folder:
-            print(folder)
-            folder = [f for f in remote_folders_map if f['lower']
-                      == folder][0]['original']
 
-            rv, data = mail.select(folder)
+            folders = [folders_by_lower[folder] for folder in args.remote_folder]
+        print(args.remote_folder)
 
-            if rv == 'OK':
-                print(Fore.GREEN + 'Processing mailbox: ' + Fore.YELLOW + folder)
+        # a folder given twice would be downloaded (and deleted) by two
+        # workers at once
+        folders = list({folder['original']: folder for folder in folders}.values())
 
-                process(mail, folder)
+        # the folder workers open their own connections
+        connections.remove(mail)
+        mail.logout()
 
-                mail.close()
-            else:
-                raise ConnectionError('Unable to open mailbox.', folder, rv)
+        # spawn rather than fork the workers: this process runs several threads
+        with ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                 mp_context=multiprocessing.get_context('spawn')) as parse_pool, \
+                ThreadPoolExecutor(max_workers=args.parallel) as executor:
+            futures = [executor.submit(run_folder, folder['original'], folder['name'])
+                       for folder in folders]
+            try:
+                # re-raise the first error of the workers
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # stop the running folders and drop the pending ones
+                stop_event.set()
+                executor.shutdown(cancel_futures=True)
+                raise
     except BaseException as e:
-        traceback.print_exc()
-        print(Back.RED + Fore.BLACK +
-              '[ERROR]' + Style.RESET_ALL, Fore.RED + type(e).__name__, str(e.args))
+        with PRINT_LOCK:
+            traceback.print_exc()
+        log(Back.RED + Fore.BLACK +
+            '[ERROR]' + Style.RESET_ALL, Fore.RED + type(e).__name__, str(e.args))
     finally:
-        mail.logout()
+        for mail in connections:
+            try:
+                mail.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
 
         print(Style.RESET_ALL)
 